@@ -0,0 +1,290 @@
+import bisect
+import email.utils
+import gzip
+import http.client
+import io
+import logging
+import random
+import select
+import socket
+import ssl
+import sys
+import time
+import urllib.error
+import urllib.parse
+from collections.abc import Callable
+
+import certifi
+import orjson
+
+# Built once, loading the CA bundle is too slow to repeat per connection.
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+# Discord only allows certain user-agents, others it'll block with 403
+# without explanation.
+# https://github.com/discord/discord-api-docs/issues/4908
+USER_AGENT = 'DiscordBot (private use) Python-urllib/3.11'
+
+COMMON_HEADERS = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Discord caps message content at 2000 characters, leave some headroom.
+MAX_COMMENT_LENGTH = 1800
+
+# Transient statuses worth retrying, anything else is raised straight away.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# A 5xx on a webhook post may come after Discord already posted the message,
+# only a rate limited post is certain not to have gone through.
+WEBHOOK_RETRY_STATUSES = frozenset({429})
+MAX_ATTEMPTS = 5
+# Longest we'll wait before a retry, whatever the server asks for.
+MAX_RETRY_DELAY = 60
+
+# Methods safe to send twice, a reset after a POST went out may mean the
+# server already acted on it.
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD'})
+
+# Goes to the same handler as the bot's own logger, see setup_logging().
+logger = logging.getLogger(__name__)
+
+
+class KeepAliveConnection:
+    '''HTTPS connection to a single host that's kept open between requests.
+
+    Saves a TCP + TLS handshake on every poll and webhook post. Responses are
+    requested gzipped and decompressed transparently.
+    '''
+
+    def __init__(self, host: str, context: ssl.SSLContext = SSL_CONTEXT):
+        self.host = host
+        self.conn = http.client.HTTPSConnection(host, timeout=15, context=context)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[http.client.HTTPResponse, bytes]:
+        headers = {**COMMON_HEADERS, **headers} if headers else COMMON_HEADERS
+        self.drop_if_closed()
+        try:
+            try:
+                return self._request(method, path, body, headers)
+            except (ConnectionResetError, BrokenPipeError):
+                # The server dropped the idle connection while we were sleeping,
+                # http.client reconnects on the next request.
+                if method not in IDEMPOTENT_METHODS:
+                    raise
+                return self._request(method, path, body, headers)
+        except urllib.error.HTTPError:
+            raise
+        except OSError as e:
+            # Wrapped like urlopen() does, so callers' URLError handling applies.
+            raise urllib.error.URLError(e) from e
+
+    def drop_if_closed(self):
+        '''Close the connection if the server already closed its end.
+
+        An idle socket that's readable has hit EOF (or got data we never asked
+        for), either way it can't carry another request. Catches most stale
+        connections before a request is written, so they don't need replaying.
+        '''
+        sock = self.conn.sock
+        if sock is not None and select.select([sock], [], [], 0)[0]:
+            self.conn.close()
+
+    def _request(
+        self, method, path, body, headers
+    ) -> tuple[http.client.HTTPResponse, bytes]:
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            if response.getheader('Content-Encoding') == 'gzip':
+                # Decompress straight off the socket, without buffering the
+                # compressed body first.
+                data = gzip.GzipFile(fileobj=response).read()
+            else:
+                data = response.read()
+        except Exception:
+            self.conn.close()
+            raise
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(
+                f'https://{self.host}{path}',
+                response.status,
+                response.reason,
+                response.headers,
+                io.BytesIO(data),
+            )
+
+        return response, data
+
+
+def retry_after(err: urllib.error.HTTPError) -> float:
+    '''Seconds the server asked us to wait, 0 if it didn't say.'''
+    value = err.headers.get('Retry-After')
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            # HTTP-date form
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # Discord also reports it in the JSON body of a 429.
+    # https://discord.com/developers/docs/topics/rate-limits
+    try:
+        return float(orjson.loads(err.read())['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return 0.0
+
+
+def with_retry(fn, *args, statuses=RETRY_STATUSES, **kwargs):
+    '''Call fn, retrying responses with a status in statuses with jittered exponential backoff.'''
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except urllib.error.HTTPError as e:
+            if e.code not in statuses or attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = max(
+                min(retry_after(e), MAX_RETRY_DELAY),
+                random.uniform(0, min(MAX_RETRY_DELAY, 2**attempt)),
+            )
+            logger.warning('HTTP %d, retrying in %.1fs', e.code, delay)
+            time.sleep(delay)
+
+
+class DiscordWebhook:
+    '''Posts to a Discord webhook over a kept-alive connection.
+
+    Posts are paced by the rate limit headers Discord sends back, and rate
+    limited responses are retried with with_retry().
+    https://discord.com/developers/docs/topics/rate-limits
+    '''
+
+    def __init__(self, url: str | None, context: ssl.SSLContext = SSL_CONTEXT):
+        self.url = url
+        self.conn = KeepAliveConnection('discord.com', context)
+        # time.monotonic() value until which the webhook's rate limit bucket
+        # is empty.
+        self.rate_limit_reset = 0.0
+
+    def post(self, post_data: dict):
+        if not self.url:
+            raise Exception('WEBHOOK_URL not set')
+
+        # Only wait when the previous post used up the rate limit bucket,
+        # rather than a fixed delay between every post.
+        time.sleep(max(0.0, self.rate_limit_reset - time.monotonic()))
+
+        response, _ = with_retry(
+            self.conn.request,
+            'POST',
+            urllib.parse.urlsplit(self.url).path,
+            body=orjson.dumps(post_data),
+            headers=JSON_HEADERS,
+            statuses=WEBHOOK_RETRY_STATUSES,
+        )
+        if response.getheader('X-RateLimit-Remaining') == '0':
+            self.rate_limit_reset = time.monotonic() + float(
+                response.getheader('X-RateLimit-Reset-After', 0)
+            )
+
+
+IASSET_EMOJIS = {
+    'iUSD': '<:iUSDemoji:1230941267622367393>',
+    'iBTC': '<:iBTCemoji:1230941348744401047>',
+    'iETH': '<:iETHemoji:1230941175607722136>',
+    'iSOL': '<:iSOLemoji:1311396708143464479>',
+}
+
+
+def get_iasset_emoji(iasset_name: str) -> str:
+    return IASSET_EMOJIS.get(iasset_name, '')
+
+
+FISH_SCALE_THRESHOLDS = (1000, 10_000, 100_000, 1_000_000)
+FISH_SCALE_EMOJIS = ('🦐', '🐟', '🐬', '🦈', '🐳')
+
+
+def get_fish_scale_emoji(ada: float) -> str:
+    if not ada:
+        return ''
+
+    i = bisect.bisect_right(FISH_SCALE_THRESHOLDS, ada)
+    emoji = FISH_SCALE_EMOJIS[i]
+    if i == len(FISH_SCALE_THRESHOLDS):
+        emoji += int(ada // 1_000_000) * '🚨'
+    return emoji
+
+
+def round_to_str(num: float, precision: int) -> str:
+    rounded = f'{num:,.{precision}f}'
+    if precision == 0:
+        return rounded
+    else:
+        return rounded.rstrip('0').rstrip('.')
+
+
+def setup_logging(name: str) -> logging.Logger:
+    '''Log the named bot logger's and bot_core's records to stderr.'''
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '%(asctime)s [%(levelname)8s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    formatter.converter = time.gmtime
+    ch.setFormatter(formatter)
+
+    bot_logger = logging.getLogger(name)
+    for configured in (bot_logger, logger):
+        configured.setLevel(logging.DEBUG)
+        configured.addHandler(ch)
+    return bot_logger
+
+
+def webhook_sanity_check(webhook_url: str | None):
+    if not webhook_url:
+        raise Exception('WEBHOOK_URL env var not set')
+    elif not webhook_url.startswith('https://discord.com/api/webhooks/'):
+        raise Exception("WEBHOOK_URL isn't https://discord.com/api/webhooks/…")
+    elif len(webhook_url) != 121:
+        raise Exception('WEBHOOK_URL length not 121')
+
+
+def poll_forever(
+    poll: Callable[[], None],
+    interval: float,
+    fatal: tuple[type[Exception], ...] = (),
+):
+    '''Call poll every interval seconds, logging network errors instead of exiting.
+
+    Polls start interval apart however long each one took. Exceptions of a
+    type in fatal are logged and exit the bot, anything else unexpected
+    propagates (as does sys.exit() from poll) so the bot is restarted
+    rather than carrying on in a bad state.
+    '''
+    next_poll = time.monotonic() + interval
+    while True:
+        time.sleep(max(0.0, next_poll - time.monotonic()))
+        next_poll = time.monotonic() + interval
+        try:
+            poll()
+        except fatal as e:
+            logger.error(e)
+            sys.exit(1)
+        except http.client.RemoteDisconnected:
+            logger.warning('Remote end closed connection without response')
+        except urllib.error.HTTPError as e:
+            logger.warning('HTTP Error occurred with status code: %d', e.code)
+        except urllib.error.URLError as e:
+            logger.warning('URL Error occurred: %s', e.reason)
+        except http.client.HTTPException:
+            logger.warning('HTTP Exception occurred')
+        except socket.timeout:
+            logger.warning('Socket Timeout occurred')
@@ -1,26 +1,36 @@
 import datetime
+import functools
 import gzip
-import http.client
 import json
 import logging
-import math
 import os
-import socket
 import sys
 import time
-import urllib.error
-import urllib.parse
-import urllib.request
 from dataclasses import dataclass
 from enum import Enum, auto
-import ssl
-import certifi
+from operator import itemgetter
+
+import fastjsonschema
+import orjson
+
+from bot_core import (
+    MAX_COMMENT_LENGTH,
+    DiscordWebhook,
+    KeepAliveConnection,
+    get_fish_scale_emoji,
+    get_iasset_emoji,
+    poll_forever,
+    round_to_str,
+    setup_logging,
+    webhook_sanity_check,
+)
 
-ssl._create_default_https_context = lambda: ssl.create_default_context(cafile=certifi.where())
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
 
-import jsonschema
+logger = logging.getLogger('cdp')
 
-WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+# Events moving less ADA than this aren't posted to Discord.
+MIN_ADA = 25_000
 
 
 class CdpEventType(Enum):
@@ -32,7 +42,7 @@ class CdpEventType(Enum):
     MERGE = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class CdpEvent:
     type: CdpEventType
     ada: float
@@ -44,86 +54,86 @@ class CdpEvent:
     tx_id: str | None  # Closed account's final tx_id can't be discerned from API.
 
 
-def discord_comment(msg: str):
-    if not WEBHOOK_URL:
-        raise Exception('WEBHOOK_URL not set')
-
-    req = urllib.request.Request(
-        WEBHOOK_URL,
-        method='POST',
-        data=json.dumps({'content': msg}).encode('utf-8'),
-        headers={
-            'Content-Type': 'application/json',
-            # Discord only allows certain user-agents, others it'll block with 403
-            # without explanation.
-            # https://github.com/discord/discord-api-docs/issues/4908
-            'User-Agent': 'DiscordBot (private use) Python-urllib/3.11',
-        },
-    )
-
-    urllib.request.urlopen(req, timeout=15)
-
+analytics_conn = KeepAliveConnection('analytics.indigoprotocol.io')
+webhook = DiscordWebhook(WEBHOOK_URL)
 
-def get_iasset_emoji(iasset_name: str) -> str:
-    discord_emojis = {
-        'iUSD': '<:iUSDemoji:1230941267622367393>',
-        'iBTC': '<:iBTCemoji:1230941348744401047>',
-        'iETH': '<:iETHemoji:1230941175607722136>',
-        'iSOL': '<:iSOLemoji:1311396708143464479>'
-    }
 
-    if iasset_name in discord_emojis:
-        return discord_emojis[iasset_name]
-    else:
-        return ''
-
-
-def get_fish_scale_emoji(ada: float) -> str:
-    if not ada:
-        return ''
-    elif ada < 1000:
-        return '🦐'
-    elif ada < 10_000:
-        return '🐟'
-    elif ada < 100_000:
-        return '🐬'
-    elif ada < 1_000_000:
-        return '🦈'
-    elif ada >= 1_000_000:
-        return '🐳' + math.floor(ada / 1_000_000) * '🚨'
-    else:
-        return ''
+def batch_comments(comments: list[str]) -> list[str]:
+    '''Joins comments into as few messages as fit in MAX_COMMENT_LENGTH.
 
-
-def round_to_str(num: float, precision: int) -> str:
-    rounded = f'{num:,.{precision}f}'
-    if precision == 0:
-        return rounded
-    else:
-        return str(rounded).rstrip('0').rstrip('.')
+    Saves a webhook round trip, and a rate limit slot, per merged comment.
+    '''
+    batches: list[list[str]] = []
+    length = 0
+    for comment in comments:
+        if batches and length + 2 + len(comment) <= MAX_COMMENT_LENGTH:
+            batches[-1].append(comment)
+            length += 2 + len(comment)
+        else:
+            batches.append([comment])
+            length = len(comment)
+    return ['\n\n'.join(batch) for batch in batches]
+
+
+EXPLORER_LINKS = (
+    '[cexplorer.io](<https://cexplorer.io/tx/{tx_id}>)  ✧  '
+    '[adastat.net](<https://adastat.net/transactions/{tx_id}>)  ✧  '
+    '[cardanoscan.io]'
+    '(<https://cardanoscan.io/transaction/{tx_id}>)  ✧  '
+    '[explorer.cardano.org]'
+    '(https://explorer.cardano.org/en/transaction?id={tx_id})'
+)
+
+# One message template per event type, filled in by event_to_discord_comment.
+EVENT_TEMPLATES = {
+    CdpEventType.OPEN: (
+        '{emoji} **CDP opened**\n'
+        '- +{ada:,.0f} ADA {fish}\n'
+        '- Debt: {debt} {iasset}\n'
+        '- New TVL: {tvl:,.0f} ADA\n'
+        '- Owner PKH: `{owner}`\n' + EXPLORER_LINKS
+    ),
+    CdpEventType.CLOSE: (
+        '{emoji} **CDP closed**\n'
+        '- -{ada:,.0f} ADA {fish}\n'
+        '- Debt: {debt} {iasset}\n'
+        # '- 2% to INDY stakers: {tax:,.0f} ADA\n'
+        '- New TVL: {tvl:,.0f} ADA\n'
+        '- Owner PKH: `{owner}`'
+    ),
+    CdpEventType.DEPOSIT: (
+        '**Deposit into {emoji} CDP**\n'
+        '- +{ada:,.0f} ADA {fish}\n'
+        '- Debt: {debt} {iasset}\n'
+        '- New collateral: {new_collateral:,.0f} ADA\n'
+        '- Change: {pct_change:+.{pct_prec}f}%\n'
+        '- New TVL: {tvl:,.0f} ADA\n'
+        '- Owner PKH: `{owner}`\n' + EXPLORER_LINKS
+    ),
+    CdpEventType.WITHDRAW: (
+        '**Withdrawal from {emoji} CDP**\n'
+        '- -{ada:,.0f} ADA {fish}\n'
+        '- Debt: {debt} {iasset}\n'
+        '- New collateral: {new_collateral:,.0f} ADA\n'
+        '- Change: {pct_change:+.{pct_prec}f}%\n'
+        # '- 2% to INDY stakers: {tax:,.0f} ADA\n'
+        '- New TVL: {tvl:,.0f} ADA\n'
+        '- Owner PKH: `{owner}`\n' + EXPLORER_LINKS
+    ),
+    CdpEventType.FREEZE: (
+        '**{emoji} CDP frozen** ❄️\n'
+        '- -{ada:,.0f} ADA {fish}\n'
+        '- Debt: {debt} {iasset}\n'
+        '- Owner PKH: `{owner}`\n' + EXPLORER_LINKS
+    ),
+    CdpEventType.MERGE: (
+        '**Frozen {emoji} CDPs merged** ↔️\n'
+        '- -{ada:,.0f} ADA {fish}\n' + EXPLORER_LINKS
+    ),
+}
 
 
 def event_to_discord_comment(event: CdpEvent) -> str:
-    lines: list[str] = []
-
-    iasset_emoji = get_iasset_emoji(event.iasset_name)
-
-    if event.type == CdpEventType.OPEN:
-        lines.append(f'{iasset_emoji} **CDP opened**')
-    elif event.type == CdpEventType.CLOSE:
-        lines.append(f'{iasset_emoji} **CDP closed**')
-    elif event.type == CdpEventType.DEPOSIT:
-        lines.append(f'**Deposit into {iasset_emoji} CDP**')
-    elif event.type == CdpEventType.WITHDRAW:
-        lines.append(f'**Withdrawal from {iasset_emoji} CDP**')
-    elif event.type == CdpEventType.FREEZE:
-        lines.append(f'**{iasset_emoji} CDP frozen** ❄️')
-    elif event.type == CdpEventType.MERGE:
-        lines.append(f'**Frozen {iasset_emoji} CDPs merged** ↔️')
-
-    sign = '+' if event.type in (CdpEventType.OPEN, CdpEventType.DEPOSIT) else '-'
-    lines.append(f'- {sign}{event.ada:,.0f} ADA {get_fish_scale_emoji(event.ada)}')
-
     if event.debt >= 1000:
         debt_str = round_to_str(event.debt, 0)
     elif event.debt >= 1:
@@ -131,134 +141,184 @@ def event_to_discord_comment(event: CdpEvent) -> str:
     else:
         debt_str = f'{event.debt}'
 
-    if event.type != CdpEventType.MERGE:
-        lines.append(f'- Debt: {debt_str} {event.iasset_name}')
-
-    if event.type not in (CdpEventType.FREEZE, CdpEventType.MERGE):
-        if event.new_collateral is not None and event.type in (
-            CdpEventType.DEPOSIT,
-            CdpEventType.WITHDRAW,
-        ):
-            if event.type == CdpEventType.DEPOSIT:
-                pct_change = (event.ada / event.new_collateral) * 100
-            else:
-                pct_change = -1 * event.ada / (event.ada + event.new_collateral) * 100
-            pct_prec = 0 if 1 <= abs(pct_change) <= 99 else 1
-            collateral = f'{event.new_collateral:,.0f}'
-            lines.append(f'- New collateral: {collateral} ADA')
-            lines.append(f'- Change: {pct_change:+.{pct_prec}f}%')
-
-        # if event.type in (CdpEventType.WITHDRAW, CdpEventType.CLOSE):
-        #     tax = event.ada * 0.02
-        #     lines.append(f'- 2% to INDY stakers: {tax:,.0f} ADA')
-
-        lines.append(f'- New TVL: {event.tvl:,.0f} ADA')
-
-    if event.type != CdpEventType.MERGE:
-        lines.append(f'- Owner PKH: `{event.owner}`')
-
-    if event.type != CdpEventType.CLOSE:
-        lines.append(
-            f'[cexplorer.io](<https://cexplorer.io/tx/{event.tx_id}>)  ✧  '
-            f'[adastat.net](<https://adastat.net/transactions/{event.tx_id}>)  ✧  '
-            '[cardanoscan.io]'
-            f'(<https://cardanoscan.io/transaction/{event.tx_id}>)  ✧  '
-            '[explorer.cardano.org]'
-            f'(https://explorer.cardano.org/en/transaction?id={event.tx_id})'
-        )
+    fields = {
+        'emoji': get_iasset_emoji(event.iasset_name),
+        'ada': event.ada,
+        'fish': get_fish_scale_emoji(event.ada),
+        'debt': debt_str,
+        'iasset': event.iasset_name,
+        'new_collateral': event.new_collateral,
+        'tvl': event.tvl,
+        'owner': event.owner,
+        'tx_id': event.tx_id,
+    }
 
-    return '\n'.join(lines)
+    if event.type == CdpEventType.DEPOSIT:
+        pct_change = (event.ada / event.new_collateral) * 100
+    elif event.type == CdpEventType.WITHDRAW:
+        pct_change = -1 * event.ada / (event.ada + event.new_collateral) * 100
+    else:
+        pct_change = 0.0
+    fields['pct_change'] = pct_change
+    fields['pct_prec'] = 0 if 1 <= abs(pct_change) <= 99 else 1
 
+    return EVENT_TEMPLATES[event.type].format_map(fields)
 
-def fetch_cdps(log_dir: str, at_unix_time: float | None = None):
-    url = 'https://analytics.indigoprotocol.io/api/cdps'
-    headers = {'Content-Type': 'application/json'}
 
+def fetch_cdps(
+    log_dir: str, at_unix_time: float | None = None, full_validation: bool = True
+):
     if at_unix_time is not None:
         params = {'timestamp': at_unix_time}
-        data = json.dumps(params).encode('utf-8')
-        req = urllib.request.Request(url, data=data, headers=headers, method='POST')
+        _, response = analytics_conn.request(
+            'POST',
+            '/api/cdps',
+            body=orjson.dumps(params),
+            headers={'Content-Type': 'application/json'},
+        )
     else:
-        req = urllib.request.Request(url)
+        _, response = analytics_conn.request('GET', '/api/cdps')
 
-    f = urllib.request.urlopen(req, timeout=15)
-    response = f.read().decode('utf-8')
-    json_response = json.loads(response)
+    json_response = orjson.loads(response)
 
     if at_unix_time is not None:
         dt = datetime.datetime.fromtimestamp(at_unix_time)
     else:
         dt = datetime.datetime.now()
 
-    err = validate_cdps_json(json_response)
+    err = validate_cdps_json(json_response, full=full_validation)
     if err is not None:
         log_file = (
             dt.strftime('%Y-%m-%d-%H-%M-%S-') + str(int(dt.timestamp())) + '.json.gz'
         )
         logger.error('/cdps response not valid against schema')
         logger.error(err)
-        logger.error(f'Log of invalid JSON: {log_file}')
-        print(err)
+        logger.error('Log of invalid JSON: %s', log_file)
 
         with gzip.open(os.path.join(log_dir, log_file), 'wt') as log_file:
             json.dump(json_response, log_file, indent=4)
 
-    return json_response
+    return normalize_cdps(json_response)
+
+
+def normalize_cdps(cdps: list[dict]) -> list[dict]:
+    '''Adds ADA-denominated `_ada` and `_debt` fields to every CDP.
+
+    Done once per fetch so event generation doesn't keep converting the same
+    lovelace amounts.
+    '''
+    for d in cdps:
+        d['_ada'] = d['collateralAmount'] / 1e6
+        d['_debt'] = d['mintedAmount'] / 1e6
+    return cdps
+
+
+@functools.lru_cache(maxsize=1)
+def load_cdps_schema() -> dict:
+    # Resolved next to this file so the schema is found regardless of the
+    # working directory the bot was started from.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cdps-schema.json')
+    with open(path) as f:
+        return json.load(f)
+
+
+@functools.cache
+def get_cdps_validator():
+    # Compiling the schema is the expensive part of validation, so it's done
+    # once and reused for every /cdps poll.
+    return fastjsonschema.compile(load_cdps_schema())
 
 
-def validate_cdps_json(json_response):
-    with open('cdps-schema.json') as f:
-        schema = json.load(f)
+# Every Nth poll validates the whole /cdps response, the others only validate
+# CDPs from its head and tail. The schema is only there to notice the API
+# drifting, which a sample catches just as well.
+FULL_VALIDATION_INTERVAL = 10
+VALIDATION_SAMPLE_SIZE = 8
+
+
+def validate_cdps_json(json_response, full: bool = True):
+    if (
+        not full
+        and isinstance(json_response, list)
+        and len(json_response) > 2 * VALIDATION_SAMPLE_SIZE
+    ):
+        json_response = (
+            json_response[:VALIDATION_SAMPLE_SIZE]
+            + json_response[-VALIDATION_SAMPLE_SIZE:]
+        )
+
     try:
-        jsonschema.validate(json_response, schema)
+        get_cdps_validator()(json_response)
         return None
-    except jsonschema.exceptions.ValidationError as e:
+    except fastjsonschema.JsonSchemaException as e:
         return e
 
 
-def generate_cdp_events(old_list: list[dict], new_list: list[dict]) -> list[CdpEvent]:
-    cdp_events = []
-
-    # Separate the CDPs with owners and without owners
-    old_with_owner = [d for d in old_list if d['owner'] is not None]
-    old_without_owner = [d for d in old_list if d['owner'] is None]
-    new_with_owner = [d for d in new_list if d['owner'] is not None]
-    new_without_owner = [d for d in new_list if d['owner'] is None]
+def generate_cdp_events(
+    old_list: list[dict], new_list: list[dict], min_ada: float = 0
+) -> tuple[list[CdpEvent], int]:
+    '''Diffs two /cdps snapshots into events.
 
-    # Create dictionaries for CDPs with owners
-    old_dict_with_owner = {(d['owner'], d['asset']): d for d in old_with_owner}
-    new_dict_with_owner = {(d['owner'], d['asset']): d for d in new_with_owner}
-
-    # Create dictionaries for CDPs without owners, linking them based on collateralAmount, mintedAmount, and asset
-    old_dict_without_owner = {
-        (d['collateralAmount'], d['mintedAmount'], d['asset']): d
-        for d in old_without_owner
-    }
-    new_dict_without_owner = {
-        (d['collateralAmount'], d['mintedAmount'], d['asset']): d
-        for d in new_without_owner
-    }
+    Events moving less than `min_ada` ADA are skipped without being built, but
+    still counted: returns the events along with the total number of changes,
+    skipped ones included, for the runaway guard.
+    '''
+    cdp_events = []
+    skipped = 0
+
+    # Key CDPs with owners by (owner, asset) and link CDPs without owners based
+    # on collateralAmount, mintedAmount and asset. Owned CDPs from the old list
+    # are indexed the same way, so a newly frozen CDP can be matched to its
+    # previous owner with a lookup instead of a scan. First match wins there.
+    old_dict_with_owner: dict[tuple[str, str], dict] = {}
+    old_dict_without_owner: dict[tuple[int, int, str], dict] = {}
+    old_by_triple: dict[tuple[int, int, str], dict] = {}
+    for d in old_list:
+        triple = (d['collateralAmount'], d['mintedAmount'], d['asset'])
+        if d['owner'] is None:
+            old_dict_without_owner[triple] = d
+        else:
+            old_dict_with_owner[(d['owner'], d['asset'])] = d
+            old_by_triple.setdefault(triple, d)
+
+    new_dict_with_owner: dict[tuple[str, str], dict] = {}
+    new_dict_without_owner: dict[tuple[int, int, str], dict] = {}
+    for d in new_list:
+        if d['owner'] is None:
+            new_dict_without_owner[
+                (d['collateralAmount'], d['mintedAmount'], d['asset'])
+            ] = d
+        else:
+            new_dict_with_owner[(d['owner'], d['asset'])] = d
 
-    tvl = sum([x['collateralAmount'] / 1e6 for x in new_list])
+    tvl = sum(map(itemgetter('collateralAmount'), new_list)) / 1e6
 
     # Process CDPs with owners
     for new_key, new_cdp in new_dict_with_owner.items():
         if new_key not in old_dict_with_owner and new_cdp['owner'] != 'NULL':
             # OPEN event
-            cdp_events.append(create_cdp_event(CdpEventType.OPEN, new_cdp, tvl))
+            if new_cdp['_ada'] >= min_ada:
+                cdp_events.append(create_cdp_event(CdpEventType.OPEN, new_cdp, tvl))
+            else:
+                skipped += 1
         else:
             old_cdp = old_dict_with_owner[new_key]
-            create_deposit_withdraw_or_freeze_event(old_cdp, new_cdp, tvl, cdp_events)
+            skipped += create_deposit_withdraw_or_freeze_event(
+                old_cdp, new_cdp, tvl, cdp_events, min_ada
+            )
 
     frozen: dict[tuple[str, str], bool] = {}
 
     # Process CDPs without owners
     for new_key, new_cdp in new_dict_without_owner.items():
         if new_key not in old_dict_without_owner:
-            old_cdp = find_corresponding_cdp_with_owner(old_with_owner, new_cdp)
+            old_cdp = find_corresponding_cdp_with_owner(old_by_triple, new_cdp)
             if old_cdp is not None:
                 # FREEZE event
                 frozen[(old_cdp['owner'], old_cdp['asset'])] = True
+                if old_cdp['_ada'] < min_ada:
+                    skipped += 1
+                    continue
                 cdp_events.append(
                     create_cdp_event(
                         CdpEventType.FREEZE,
@@ -274,32 +334,42 @@ def generate_cdp_events(old_list: list[dict], new_list: list[dict]) -> list[CdpE
             continue
         if old_key not in new_dict_with_owner:
             # CLOSE event
+            if old_cdp['_ada'] < min_ada:
+                skipped += 1
+                continue
             cdp_events.append(
                 create_cdp_event(
                     CdpEventType.CLOSE, old_cdp, tvl, new_collateral=None, tx_id=None
                 )
             )
 
-    return cdp_events
+    return cdp_events, len(cdp_events) + skipped
 
 
 def create_cdp_event(event_type, cdp, tvl, new_collateral=None, tx_id=None):
     return CdpEvent(
         type=event_type,
-        ada=cdp['collateralAmount'] / 1e6,
-        new_collateral=new_collateral
-        if new_collateral is not None
-        else cdp['collateralAmount'] / 1e6,
+        ada=cdp['_ada'],
+        new_collateral=new_collateral if new_collateral is not None else cdp['_ada'],
         tvl=tvl,
         iasset_name=cdp['asset'],
-        debt=cdp['mintedAmount'] / 1e6,
+        debt=cdp['_debt'],
         owner=cdp['owner'],
         tx_id=tx_id if tx_id is not None else cdp['output_hash'],
     )
 
 
-def create_deposit_withdraw_or_freeze_event(old_cdp, new_cdp, tvl, cdp_events):
+def create_deposit_withdraw_or_freeze_event(
+    old_cdp, new_cdp, tvl, cdp_events, min_ada=0
+) -> int:
+    '''Appends the event(s) for an owned CDP to cdp_events.
+
+    Returns how many were skipped for being under `min_ada`.
+    '''
     if new_cdp['collateralAmount'] != old_cdp['collateralAmount']:
+        ada = abs(new_cdp['collateralAmount'] - old_cdp['collateralAmount']) / 1e6
+        if ada < min_ada:
+            return 1
         event_type = (
             CdpEventType.DEPOSIT
             if new_cdp['collateralAmount'] > old_cdp['collateralAmount']
@@ -308,27 +378,30 @@ def create_deposit_withdraw_or_freeze_event(old_cdp, new_cdp, tvl, cdp_events):
         cdp_events.append(
             CdpEvent(
                 type=event_type,
-                ada=abs(new_cdp['collateralAmount'] - old_cdp['collateralAmount'])
-                / 1e6,
+                ada=ada,
                 tvl=tvl,
-                new_collateral=new_cdp['collateralAmount'] / 1e6,
+                new_collateral=new_cdp['_ada'],
                 iasset_name=new_cdp['asset'],
-                debt=new_cdp['mintedAmount'] / 1e6,
+                debt=new_cdp['_debt'],
                 owner=new_cdp['owner'],
                 tx_id=new_cdp['output_hash'],
             )
         )
     elif new_cdp['owner'] is None and old_cdp['owner'] is not None:
+        is_merge = old_cdp['owner'] == '' or old_cdp['owner'] == 'NULL'
+        if old_cdp['_ada'] < min_ada:
+            return 2 if is_merge else 1
+
         # MERGE event
-        if old_cdp['owner'] == '' or old_cdp['owner'] == 'NULL':
+        if is_merge:
             cdp_events.append(
                 CdpEvent(
                     type=CdpEventType.MERGE,
-                    ada=old_cdp['collateralAmount'] / 1e6,
-                    new_collateral=new_cdp['collateralAmount'] / 1e6,
+                    ada=old_cdp['_ada'],
+                    new_collateral=new_cdp['_ada'],
                     tvl=tvl,
                     iasset_name=old_cdp['asset'],
-                    debt=old_cdp['mintedAmount'] / 1e6,
+                    debt=old_cdp['_debt'],
                     owner=None,
                     tx_id=old_cdp['output_hash'],
                 )
@@ -338,49 +411,27 @@ def create_deposit_withdraw_or_freeze_event(old_cdp, new_cdp, tvl, cdp_events):
         cdp_events.append(
             CdpEvent(
                 type=CdpEventType.FREEZE,
-                ada=old_cdp['collateralAmount'] / 1e6,
-                new_collateral=new_cdp['collateralAmount'] / 1e6,
+                ada=old_cdp['_ada'],
+                new_collateral=new_cdp['_ada'],
                 tvl=tvl,
                 iasset_name=old_cdp['asset'],
-                debt=old_cdp['mintedAmount'] / 1e6,
+                debt=old_cdp['_debt'],
                 owner=old_cdp['owner'],
                 tx_id=old_cdp['output_hash'],
             )
         )
 
-
-def find_corresponding_cdp_with_owner(cdp_list, cdp_without_owner):
-    for cdp in cdp_list:
-        if (
-            cdp['collateralAmount'] == cdp_without_owner['collateralAmount']
-            and cdp['mintedAmount'] == cdp_without_owner['mintedAmount']
-            and cdp['asset'] == cdp_without_owner['asset']
-        ):
-            return cdp
-    return None
-
-
-def setup_logging() -> logging.Logger:
-    logger = logging.getLogger('liquidations')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s [%(levelname)8s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    formatter.converter = time.gmtime
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
+    return 0
 
 
-def webhook_sanity_check():
-    if not WEBHOOK_URL:
-        raise Exception('WEBHOOK_URL env var not set')
-    elif not WEBHOOK_URL.startswith('https://discord.com/api/webhooks/'):
-        raise Exception("WEBHOOK_URL isn't https://discord.com/api/webhooks/…")
-    elif len(WEBHOOK_URL) != 121:
-        raise Exception('WEBHOOK_URL length not 121')
+def find_corresponding_cdp_with_owner(old_by_triple, cdp_without_owner):
+    return old_by_triple.get(
+        (
+            cdp_without_owner['collateralAmount'],
+            cdp_without_owner['mintedAmount'],
+            cdp_without_owner['asset'],
+        )
+    )
 
 
 def get_old_cdps(log_dir: str, time_window: datetime.timedelta) -> list[dict]:
@@ -390,53 +441,57 @@ def get_old_cdps(log_dir: str, time_window: datetime.timedelta) -> list[dict]:
 
 
 if __name__ == '__main__':
-    logger = setup_logging()
+    setup_logging('cdp')
 
     try:
-        webhook_sanity_check()
+        webhook_sanity_check(WEBHOOK_URL)
+        get_cdps_validator()
     except Exception as e:
         logger.error(e)
         sys.exit(1)
 
     log_dir = '/srv/cdp-log'
-    logger.info(f'Logging JSON responses to {log_dir}')
+    logger.info('Logging JSON responses to %s', log_dir)
 
     prev_cdps = fetch_cdps(log_dir)
-    logger.info(f'Fetched {len(prev_cdps)} initial CDPs')
+    logger.info('Fetched %d initial CDPs', len(prev_cdps))
 
-    while True:
-        try:
-            time.sleep(30)
-            cdps = fetch_cdps(log_dir)
-            events = generate_cdp_events(prev_cdps, cdps)
+    poll_count = 0
 
-            if len(events) > 0:
-                logger.info(f'Fetched {len(events)} new events')
-            else:
-                logger.debug(f'No new CDP events')
+    def check_cdps():
+        global prev_cdps, poll_count
 
-            if len(events) > 20:
-                logger.error(
-                    f'Suspiciously large number of events ({len(events)}), exiting'
-                )
-                sys.exit(1)
+        poll_count += 1
+        cdps = fetch_cdps(
+            log_dir,
+            full_validation=poll_count % FULL_VALIDATION_INTERVAL == 0,
+        )
+        events, num_changes = generate_cdp_events(
+            prev_cdps, cdps, min_ada=MIN_ADA
+        )
+
+        if len(events) > 0:
+            logger.info('Fetched %d new events', len(events))
+        else:
+            logger.debug('No new CDP events')
 
-            prev_cdps = cdps
+        # Counts changes under MIN_ADA too, an API glitch dropping or
+        # re-adding many CDPs shouldn't be posted at all.
+        if num_changes > 20:
+            logger.error(
+                'Suspiciously large number of events (%d), exiting', num_changes
+            )
+            sys.exit(1)
 
+        prev_cdps = cdps
+
+        # %-style placeholders have no thousands separator, so format it
+        # here, only when the record will actually be emitted.
+        if logger.isEnabledFor(logging.INFO):
             for event in events:
-                if event.ada >= 25_000:
-                    logger.info(f'Discord commenting for {event.ada:,.0f} ADA event')
-                    msg = event_to_discord_comment(event)
-                    discord_comment(msg)
-                    time.sleep(2)
-
-        except http.client.RemoteDisconnected:
-            logger.warning('Remote end closed connection without response')
-        except urllib.error.HTTPError as e:
-            logger.warning(f'HTTP Error occurred with status code: {e.code}')
-        except urllib.error.URLError:
-            logger.warning('URL Error occurred')
-        except http.client.HTTPException:
-            logger.warning('HTTP Exception occurred')
-        except socket.timeout:
-            logger.warning('Socket Timeout occurred')
+                logger.info('Discord commenting for %s ADA event', f'{event.ada:,.0f}')
+
+        for msg in batch_comments([event_to_discord_comment(e) for e in events]):
+            webhook.post({'content': msg})
+
+    poll_forever(check_cdps, 30)
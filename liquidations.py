@@ -1,119 +1,125 @@
-import http
-import json
+import bisect
 import logging
-import math
 import os
-import socket
 import sys
-import time
 import urllib.error
 import urllib.parse
-import urllib.request
+from operator import itemgetter
 from typing import Any
-import ssl
-import certifi
 
-ssl._create_default_https_context = lambda: ssl.create_default_context(cafile=certifi.where())
+import orjson
+
+from bot_core import (
+    MAX_COMMENT_LENGTH,
+    DiscordWebhook,
+    KeepAliveConnection,
+    get_fish_scale_emoji,
+    get_iasset_emoji,
+    poll_forever,
+    round_to_str,
+    setup_logging,
+    webhook_sanity_check,
+)
 
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
 
+logger = logging.getLogger('liquidations')
+
 
 class AnalyticsApiException(Exception):
     pass
 
 
-def discord_comment(post_data: dict):
-    if not WEBHOOK_URL:
-        raise Exception('WEBHOOK_URL not set')
-
-    req = urllib.request.Request(
-        WEBHOOK_URL,
-        method='POST',
-        data=json.dumps(post_data).encode('utf-8'),
-        headers={
-            'Content-Type': 'application/json',
-            # Discord only allows certain user-agents, others it'll block with 403
-            # without explanation.
-            # https://github.com/discord/discord-api-docs/issues/4908
-            'User-Agent': 'DiscordBot (private use) Python-urllib/3.11',
-        },
-    )
+analytics_conn = KeepAliveConnection('analytics.indigoprotocol.io')
+webhook = DiscordWebhook(WEBHOOK_URL)
 
-    urllib.request.urlopen(req, timeout=15)
+# (path, ETag, Last-Modified, parsed body) of the last /liquidations response,
+# so polls that find nothing new get a bodyless 304 instead.
+liquidations_cache: tuple[str, str | None, str | None, Any] | None = None
 
 
 def fetch_liquidations(after_unix_time: int | None = None):
-    url = 'https://analytics.indigoprotocol.io/api/liquidations'
+    global liquidations_cache
+
+    path = '/api/liquidations'
     if after_unix_time:
         params = {'after': after_unix_time}
         query_string = urllib.parse.urlencode(params)
-        url = url + f'?{query_string}'
-    req = urllib.request.Request(url)
-    f = urllib.request.urlopen(req, timeout=15)
-    response = f.read().decode('utf-8')
-    json_response = json.loads(response)
-    return json_response
+        path = path + f'?{query_string}'
 
+    headers = {}
+    if liquidations_cache is not None and liquidations_cache[0] == path:
+        _, etag, last_modified, _ = liquidations_cache
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
 
-def slot_to_timestamp(slot: int) -> int:
-    return slot - 4924800 + 1596491091
+    response, body = analytics_conn.request('GET', path, headers=headers)
+    if response.status == 304 and liquidations_cache is not None:
+        return liquidations_cache[3]
 
+    json_response = orjson.loads(body)
 
-def timestamp_to_slot(unix_time: int) -> int:
-    return unix_time - 1596491091 + 4924800
-
-
-def get_fish_scale_emoji(ada: float) -> str:
-    if not ada:
-        return ''
-    elif ada < 1000:
-        return '🦐'
-    elif ada < 10_000:
-        return '🐟'
-    elif ada < 100_000:
-        return '🐬'
-    elif ada < 1_000_000:
-        return '🦈'
-    elif ada >= 1_000_000:
-        return '🐳' + math.floor(ada / 1_000_000) * '🚨'
-    else:
-        return ''
+    etag = response.getheader('ETag')
+    last_modified = response.getheader('Last-Modified')
+    if etag is not None or last_modified is not None:
+        liquidations_cache = (path, etag, last_modified, json_response)
 
+    return json_response
 
-def get_iasset_icon_url(iasset_name: str) -> str | None:
-    urls = {
-        'iUSD': 'https://cdn.discordapp.com/attachments/859469846734307362/1097731509634482267/iUSDsmall.png',
-        'iBTC': 'https://cdn.discordapp.com/attachments/859469846734307362/1097731510112632862/iBTCsmall.png',
-        'iETH': 'https://cdn.discordapp.com/attachments/859469846734307362/1097731509856772136/iETHsmall.png',
-        'iSOL': 'https://cdn.discordapp.com/attachments/816779565796032513/859538870193881139/1311400287562366987/iSOLemoji.png',
-    }
 
-    if iasset_name in urls:
-        return urls[iasset_name]
-    else:
-        return None
+# Unix time of mainnet slot 0 (Shelley slot 4924800 at 1596491091).
+SLOT_EPOCH = 1596491091 - 4924800
 
 
-def get_iasset_emoji(iasset_name: str) -> str:
-    discord_emojis = {
-        'iUSD': '<:iUSDemoji:1230941267622367393>',
-        'iBTC': '<:iBTCemoji:1230941348744401047>',
-        'iETH': '<:iETHemoji:1230941175607722136>',
-        'iSOL': '<:iSOLemoji:1311396708143464479>',
-    }
+def slot_to_timestamp(slot: int) -> int:
+    return slot + SLOT_EPOCH
 
-    if iasset_name in discord_emojis:
-        return discord_emojis[iasset_name] + ' '
-    else:
-        return ''
+
+def timestamp_to_slot(unix_time: int) -> int:
+    return unix_time - SLOT_EPOCH
+
+
+IASSET_ICON_URLS = {
+    'iUSD': 'https://cdn.discordapp.com/attachments/859469846734307362/1097731509634482267/iUSDsmall.png',
+    'iBTC': 'https://cdn.discordapp.com/attachments/859469846734307362/1097731510112632862/iBTCsmall.png',
+    'iETH': 'https://cdn.discordapp.com/attachments/859469846734307362/1097731509856772136/iETHsmall.png',
+    'iSOL': 'https://cdn.discordapp.com/attachments/816779565796032513/859538870193881139/1311400287562366987/iSOLemoji.png',
+}
 
 
-def round_to_str(num: float, precision: int) -> str:
-    rounded = f'{num:,.{precision}f}'
-    if precision == 0:
-        return rounded
+def get_iasset_icon_url(iasset_name: str) -> str | None:
+    return IASSET_ICON_URLS.get(iasset_name)
+
+
+# (price_main_prec, price_inverse_prec, mcr) per iAsset.
+IASSET_PARAMS: dict[str, tuple[int, int, float]] = {
+    'iUSD': (3, 3, 1.5),
+    'iBTC': (8, 0, 1.1),
+    'iETH': (8, 0, 1.1),
+    'iSOL': (8, 0, 1.1),
+}
+
+# (bounds, precisions) per iAsset for the burned amount. An amount below
+# bounds[i] is rounded to precisions[i], None means it's printed as-is.
+IASSET_BURNED_PRECISIONS: dict[
+    str, tuple[tuple[float, ...], tuple[int | None, ...]]
+] = {
+    'iUSD': ((1, 1000), (None, 2, 0)),
+    'iBTC': ((0.1,), (6, None)),
+    'iETH': ((0.1,), (6, None)),
+    'iSOL': ((0.1,), (6, None)),
+}
+
+
+def iasset_burned_to_str(iasset: str, iasset_burned: float) -> str:
+    bounds, precisions = IASSET_BURNED_PRECISIONS[iasset]
+    precision = precisions[bisect.bisect_right(bounds, iasset_burned)]
+    if precision is None:
+        return f'{iasset_burned}'
     else:
-        return str(rounded).rstrip('0').rstrip('.')
+        return round_to_str(iasset_burned, precision)
 
 
 def liquidation_to_post_data(lq: dict) -> dict:
@@ -122,27 +128,14 @@ def liquidation_to_post_data(lq: dict) -> dict:
     collateral_ada = float(lq['collateral_absorbed']) / 1_000_000
     oracle_price = float(lq['oracle_price'])
 
-    if iasset == 'iUSD':
-        price_main_prec = 3
-        price_inverse_prec = 3
-        mcr = 1.5
-        if iasset_burned >= 1000:
-            iasset_burned_str = round_to_str(iasset_burned, 0)
-        elif iasset_burned >= 1:
-            iasset_burned_str = round_to_str(iasset_burned, 2)
-        else:
-            iasset_burned_str = f'{iasset_burned}'
-    elif iasset in ('iBTC', 'iETH', 'iSOL'):
-        price_main_prec = 8
-        price_inverse_prec = 0
-        mcr = 1.1
-        if iasset_burned < 0.1:
-            iasset_burned_str = round_to_str(iasset_burned, 6)
-        else:
-            iasset_burned_str = f'{iasset_burned}'
-    else:
+    try:
+        price_main_prec, price_inverse_prec, mcr = IASSET_PARAMS[iasset]
+    except KeyError:
         raise AnalyticsApiException(f'Unexpected iasset "{iasset}"')
 
+    iasset_burned_str = iasset_burned_to_str(iasset, iasset_burned)
+    inverse_oracle_price = 1 / oracle_price
+
     collateral_nominal = collateral_ada / mcr
     # indy_staker_rewards = 0.02 * collateral_ada
     # sp_staker_rewards = collateral_ada - indy_staker_rewards - collateral_nominal
@@ -150,13 +143,13 @@ def liquidation_to_post_data(lq: dict) -> dict:
     sp_staker_pct = sp_staker_rewards / collateral_ada * 100
 
     msg = (
-        f'- Burned: {get_iasset_emoji(iasset)}**{iasset_burned_str} {iasset}**\n'
+        f'- Burned: {get_iasset_emoji(iasset)} **{iasset_burned_str} {iasset}**\n'
         f'- Collateral: {get_fish_scale_emoji(collateral_ada)} **{round_to_str(collateral_ada, 2)} ADA**\n'
         f'  - Debt: {round_to_str(collateral_nominal, 2)} ADA\n'
         # f'  - 2% to INDY stakers: {round_to_str(indy_staker_rewards, 2)} ADA\n'
         f'  - {round_to_str(sp_staker_pct, 1)}% to {iasset} SP stakers: {round_to_str(sp_staker_rewards, 2)} ADA\n'
         f'- Oracle price: {oracle_price:,.{price_inverse_prec}f} ADA/{iasset} '
-        f'({1 / oracle_price:,.{price_main_prec}f} {iasset}/ADA)\n'
+        f'({inverse_oracle_price:,.{price_main_prec}f} {iasset}/ADA)\n'
         f'[cexplorer.io](<https://cexplorer.io/tx/{lq["output_hash"]}>)  ✧  '
         f'[adastat.net](<https://adastat.net/transactions/{lq["output_hash"]}>)  ✧  '
         f'[cardanoscan.io](<https://cardanoscan.io/transaction/{lq["output_hash"]}>)  ✧  '
@@ -197,90 +190,102 @@ def check_liquidations(last_processed: dict) -> dict:
     try:
         new_lqs = fetch_liquidations(slot_to_timestamp(last_processed['slot']))
     except urllib.error.URLError as err:
-        logger.warning(f'HTTP error (Analytics API): {err}')
+        logger.warning('HTTP error (Analytics API): %s', err)
         return local_last
 
-    logger.debug(f'Fetched {len(new_lqs)} new liquidations from API')
+    logger.debug('Fetched %d new liquidations from API', len(new_lqs))
+
+    # 'after' is a timestamp, so the API can return liquidations from the last
+    # processed one's slot again. Those are dropped before any checks, and the
+    # rest posted oldest first so a failure part way through resumes from the
+    # right place.
+    unseen = sorted(
+        (lq for lq in new_lqs if lq['id'] > last_processed['id']),
+        key=itemgetter('id'),
+    )
 
-    for lq in new_lqs:
+    posts: list[tuple[dict, dict]] = []
+    for lq in unseen:
         if not sanity_check(lq):
             logger.debug('Sanity check failed')
+            break
+        posts.append((liquidation_to_post_data(lq), lq))
+
+    for post_data, lq in batch_liquidation_posts(posts):
+        try:
+            webhook.post(post_data)
+        except urllib.error.URLError as err:
+            logger.warning('HTTP error (Discord webhook): %s', err)
             return local_last
-        if lq['id'] > last_processed['id']:
-            try:
-                discord_comment(liquidation_to_post_data(lq))
-            except urllib.error.URLError as err:
-                logger.warning(f'HTTP error (Discord webhook): {err}')
-                return local_last
-        if lq['id'] > local_last['id']:
-            local_last = lq
+        local_last = lq
 
     return local_last
 
 
-def get_last(lqs: list[dict]) -> dict:
-    return max(lqs, key=lambda x: x['id'])
+def batch_liquidation_posts(
+    posts: list[tuple[dict, dict]]
+) -> list[tuple[dict, dict]]:
+    '''Merges consecutive liquidation posts into as few messages as fit.
 
+    Posts with an embed are kept on their own so the embed isn't lost.
 
-def mock_last(lqs: list[dict], last_id: int) -> dict:
-    return tuple(filter(lambda x: x['id'] == last_id, lqs))[0]
+    Args:
+        posts: (post data, liquidation) pairs, oldest first.
 
+    Returns:
+        (post data, newest liquidation in it) pairs.
+    '''
+    batches: list[list[tuple[dict, dict]]] = []
+    length = 0
+    for post_data, lq in posts:
+        content_length = len(post_data['content'])
+        if (
+            batches
+            and 'embeds' not in post_data
+            and 'embeds' not in batches[-1][-1][0]
+            and length + 2 + content_length <= MAX_COMMENT_LENGTH
+        ):
+            batches[-1].append((post_data, lq))
+            length += 2 + content_length
+        else:
+            batches.append([(post_data, lq)])
+            length = content_length
 
-def setup_logging() -> logging.Logger:
-    logger = logging.getLogger('liquidations')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s [%(levelname)8s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    formatter.converter = time.gmtime
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
+    return [
+        (
+            {**batch[0][0], 'content': '\n\n'.join(p['content'] for p, _ in batch)},
+            batch[-1][1],
+        )
+        for batch in batches
+    ]
 
 
-def webhook_sanity_check():
-    if not WEBHOOK_URL:
-        raise Exception('WEBHOOK_URL env var not set')
-    elif not WEBHOOK_URL.startswith('https://discord.com/api/webhooks/'):
-        raise Exception("WEBHOOK_URL isn't https://discord.com/api/webhooks/…")
-    elif len(WEBHOOK_URL) != 121:
-        raise Exception('WEBHOOK_URL length not 121')
+def mock_last(lqs: list[dict], last_id: int) -> dict:
+    return tuple(filter(lambda x: x['id'] == last_id, lqs))[0]
 
 
 if __name__ == '__main__':
-    logger = setup_logging()
+    setup_logging('liquidations')
 
     try:
-        webhook_sanity_check()
+        webhook_sanity_check(WEBHOOK_URL)
     except Exception as e:
         logger.error(e)
         sys.exit(1)
 
-    last_lq = get_last(fetch_liquidations())
+    last_lq = max(fetch_liquidations(), key=itemgetter('id'))
 
-    while True:
-        try:
-            prev = last_lq
-            last_lq = check_liquidations(last_lq)
-
-            if prev != last_lq:
-                logger.info(f'New liquidation of {last_lq["asset"]}, id: {last_lq["id"]}')
-            else:
-                logger.info(f'No new liquidations, last: {last_lq["id"]}')
-        except http.client.RemoteDisconnected:
-            logger.warning('Remote end closed connection without response')
-        except urllib.error.HTTPError as e:
-            logger.warning(f'HTTP error occurred with status code: {e.code}')
-        except urllib.error.URLError as e:
-            logger.warning(f'URL error occurred: {e}')
-        except http.client.HTTPException:
-            logger.warning('HTTP exception occurred')
-        except socket.timeout:
-            logger.warning('Socket Timeout occurred')
-        except AnalyticsApiException as e:
-            logger.error(e)
-            sys.exit(1)
-        finally:
-            time.sleep(119)
+    def check_new_liquidations():
+        global last_lq
+
+        prev = last_lq
+        last_lq = check_liquidations(last_lq)
+
+        if prev != last_lq:
+            logger.info('New liquidation of %s, id: %d', last_lq['asset'], last_lq['id'])
+        else:
+            logger.info('No new liquidations, last: %d', last_lq['id'])
+
+    # An unexpected API response isn't going to fix itself, exit rather
+    # than retry.
+    poll_forever(check_new_liquidations, 119, fatal=(AnalyticsApiException,))
@@ -1,20 +1,25 @@
-import http.client
-import json
 import logging
 import os
-import socket
 import ssl
 import sys
-import time
-import urllib.error
 import urllib.parse
-import urllib.request
 from dataclasses import dataclass
-from typing import List
+from typing import Any, List
 from datetime import datetime
+from operator import itemgetter
 
+import orjson
 from dotenv import load_dotenv
 
+from bot_core import (
+    DiscordWebhook,
+    KeepAliveConnection,
+    poll_forever,
+    setup_logging,
+    webhook_sanity_check,
+    with_retry,
+)
+
 # Load environment variables from .env file if it exists
 load_dotenv()
 
@@ -23,6 +28,8 @@ context = ssl._create_unverified_context()
 
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
 
+logger = logging.getLogger('pocop_bot')
+
 # If webhook URL is not set, try to get it from command line arguments
 if not WEBHOOK_URL and len(sys.argv) > 1:
     WEBHOOK_URL = sys.argv[1]
@@ -31,55 +38,55 @@ BASE_URL = "https://pocop.indigodao.org:2053"
 POCOP_WEBSITE = "https://pocop.indigodao.org"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class PoCoPSubmission:
     link: str
     wallet: str
     date: str
 
 
-def discord_comment(post_data: dict):
-    """Send message to Discord webhook."""
-    if not WEBHOOK_URL:
-        raise Exception('WEBHOOK_URL not set')
-
-    req = urllib.request.Request(
-        WEBHOOK_URL,
-        method='POST',
-        data=json.dumps(post_data).encode('utf-8'),
-        headers={
-            'Content-Type': 'application/json',
-            'User-Agent': 'DiscordBot (private use) Python-urllib/3.11',
-        },
-    )
+pocop_conn = KeepAliveConnection(urllib.parse.urlsplit(BASE_URL).netloc, context)
+webhook = DiscordWebhook(WEBHOOK_URL, context)
 
-    urllib.request.urlopen(req, timeout=15, context=context)
+# Path -> (ETag, Last-Modified, parsed body) of the last response for each
+# page, so unchanged pages come back as a bodyless 304.
+submissions_cache: dict[str, tuple[str | None, str | None, Any]] = {}
 
 
 def fetch_pocop_submissions(page: int = 1, limit: int = 10) -> dict:
     """Fetch PoCoP submissions from the API."""
-    url = f"{BASE_URL}/json?page={page}&limit={limit}"
+    path = f"/json?page={page}&limit={limit}"
 
-    headers = {
-        'User-Agent': 'DiscordBot (private use) Python-urllib/3.11',
-        'Accept': 'application/json',
-    }
-
-    req = urllib.request.Request(url, headers=headers)
+    headers = {'Accept': 'application/json'}
+    cached = submissions_cache.get(path)
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
 
     try:
-        # Use unverified SSL context
-        f = urllib.request.urlopen(req, timeout=15, context=context)
-        response = f.read().decode('utf-8')
+        response, body = with_retry(pocop_conn.request, 'GET', path, headers=headers)
 
         # Debug information
-        logger.debug(f"Request URL: {url}")
-        logger.debug(f"Response status: {f.status}")
-        logger.debug(f"Response headers: {f.headers}")
+        logger.debug('Request URL: %s%s', BASE_URL, path)
+        logger.debug('Response status: %d', response.status)
+        logger.debug('Response headers: %s', response.headers)
+
+        if response.status == 304 and cached is not None:
+            return cached[2]
 
-        return json.loads(response)
+        json_response = orjson.loads(body)
+
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        if etag is not None or last_modified is not None:
+            submissions_cache[path] = (etag, last_modified, json_response)
+
+        return json_response
     except Exception as e:
-        logger.error(f"Error fetching PoCoP submissions: {e}")
+        logger.error('Error fetching PoCoP submissions: %s', e)
         return {}
 
 
@@ -92,23 +99,106 @@ def parse_submission(submission: dict) -> PoCoPSubmission:
     )
 
 
-def get_latest_submissions(num_pages: int = 3, limit: int = 10) -> List[PoCoPSubmission]:
-    """Fetch latest submissions from multiple pages."""
-    all_submissions = []
+if sys.version_info >= (3, 11):
+    parse_iso_datetime = datetime.fromisoformat
+else:
+    def parse_iso_datetime(value: str) -> datetime:
+        """Parse an ISO 8601 timestamp, fromisoformat() only takes a Z suffix from 3.11 on."""
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def parse_submission_date(date: str) -> datetime | None:
+    """Parse a submission's date, None if it's missing, malformed or has no UTC offset."""
+    try:
+        created_at = parse_iso_datetime(date)
+    except (TypeError, ValueError):
+        return None
+    # Naive and aware datetimes can't be compared with each other.
+    return created_at if created_at.tzinfo is not None else None
+
+
+# Newest date posted so far. Submissions are posted oldest first, so every
+# fetched submission up to this date has been posted. Compared as datetimes,
+# the API's strings don't all have the same precision.
+latest_posted_date: datetime | None = None
+
+
+def get_latest_submissions(
+    processed_links: set[str], num_pages: int = 3, limit: int = 10
+) -> List[PoCoPSubmission]:
+    """Fetch latest submissions from multiple pages, skipping links in processed_links.
+
+    Returned oldest first, the order they should be posted in.
+    """
+    new_submissions = []
+    new_links = set()
     for page in range(1, num_pages + 1):
         response = fetch_pocop_submissions(page=page, limit=limit)
-        if response and isinstance(response, dict) and 'commits' in response:
-            all_submissions.extend([parse_submission(commit) for commit in response['commits']])
-    return all_submissions
+        if not (response and isinstance(response, dict) and 'commits' in response):
+            # Posting the other pages' submissions could move
+            # latest_posted_date past ones on this page, which then never
+            # get fetched again. Try the whole pass again next poll.
+            logger.warning('Page %d of submissions unavailable, skipping this check', page)
+            return []
+        commits = response['commits']
+        oldest = None
+        for commit in commits:
+            created_at = parse_submission_date(commit.get('date'))
+            if created_at is None:
+                # Can't be ordered against the others, or posted.
+                logger.warning('Skipping submission without a valid date: %s', commit.get('link'))
+                continue
+            oldest = created_at if oldest is None else min(oldest, created_at)
+            link = commit.get('link')
+            # Skip known links before building anything for them.
+            if not link or link in processed_links or link in new_links:
+                continue
+            new_links.add(link)
+            new_submissions.append((created_at, parse_submission(commit)))
+        # A short page is the last one, don't spend a round trip on the next.
+        if len(commits) < limit:
+            break
+        # Pages go from newest to oldest, once one reaches back to what's
+        # been posted already, the rest are old too.
+        if oldest is not None and latest_posted_date is not None and oldest <= latest_posted_date:
+            break
+
+    new_submissions.sort(key=itemgetter(0))
+    return [submission for _, submission in new_submissions]
+
+
+# Link hostname (without www.) -> platform label.
+PLATFORMS = {
+    'x.com': '𝕏',
+    'mobile.x.com': '𝕏',
+    'twitter.com': 'Twitter',
+    'mobile.twitter.com': 'Twitter',
+}
+
+
+def get_platform(link: str) -> str:
+    """Label for the platform a submission link points to."""
+    host = urllib.parse.urlsplit(link).hostname or ''
+    return PLATFORMS.get(host.removeprefix('www.'), '🔗')
+
+
+# Embed parts that are the same for every submission, built once.
+VERIFICATION_FIELD = {
+    'name': '📊 Verification Status',
+    'value': 'Submission Recorded & Verified',
+    'inline': True
+}
+EMBED_FOOTER = {
+    'text': '🎨 PoCoP - Building Community Through Creative Participation | Each submission strengthens our ecosystem'
+}
 
 
 def submission_to_post_data(submission: PoCoPSubmission) -> dict:
     """Convert submission to Discord message format."""
-    created_at = datetime.fromisoformat(submission.date.replace('Z', '+00:00'))
+    created_at = parse_iso_datetime(submission.date)
     formatted_date = created_at.strftime("%Y-%m-%d %H:%M:%S UTC")
 
-    # Extract the platform (e.g., 'x.com' or 'twitter.com') from the link
-    platform = "𝕏" if "x.com" in submission.link else "Twitter" if "twitter.com" in submission.link else "🔗"
+    platform = get_platform(submission.link)
 
     message = (
         f"🎨 **New Proof of Creative Participation**\n\n"
@@ -124,20 +214,14 @@ def submission_to_post_data(submission: PoCoPSubmission) -> dict:
         'description': 'A new proof of participation has been submitted to the PoCoP system, demonstrating active engagement in the Indigo community.',
         'color': 0x6A5ACD,  # Slate blue color
         'fields': [
-            {
-                'name': '📊 Verification Status',
-                'value': 'Submission Recorded & Verified',
-                'inline': True
-            },
+            VERIFICATION_FIELD,
             {
                 'name': f'{platform} Proof',
                 'value': f'[View Social Proof]({submission.link})',
                 'inline': True
             }
         ],
-        'footer': {
-            'text': '🎨 PoCoP - Building Community Through Creative Participation | Each submission strengthens our ecosystem'
-        },
+        'footer': EMBED_FOOTER,
         'timestamp': submission.date
     }
 
@@ -146,43 +230,34 @@ def submission_to_post_data(submission: PoCoPSubmission) -> dict:
         'embeds': [embed]
     }
 
-    return {
-        'content': message,
-        'embeds': [embed]
-    }
 
+def post_submission(submission: PoCoPSubmission, processed_links: set[str]):
+    """Post a submission and record it as processed."""
+    global latest_posted_date
 
-def setup_logging() -> logging.Logger:
-    """Set up logging configuration."""
-    logger = logging.getLogger('pocop_bot')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s [%(levelname)8s] %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    formatter.converter = time.gmtime
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
+    webhook.post(submission_to_post_data(submission))
+    processed_links.add(submission.link)
+    # Only moved once the post went through, so a failed post is fetched
+    # again on the next poll.
+    created_at = parse_iso_datetime(submission.date)
+    if latest_posted_date is None or created_at > latest_posted_date:
+        latest_posted_date = created_at
 
 
-def webhook_sanity_check():
-    """Verify webhook URL is properly formatted."""
-    if not WEBHOOK_URL:
-        raise Exception('WEBHOOK_URL env var not set')
-    elif not WEBHOOK_URL.startswith('https://discord.com/api/webhooks/'):
-        raise Exception("WEBHOOK_URL isn't https://discord.com/api/webhooks/…")
-    elif len(WEBHOOK_URL) != 121:
-        raise Exception('WEBHOOK_URL length not 121')
+def check_new_submissions(processed_links: set[str]):
+    """Post submissions that aren't in processed_links yet."""
+    for submission in get_latest_submissions(processed_links):
+        logger.info('New submission found: %s', submission.link)
+        post_submission(submission, processed_links)
+
+    logger.info('Checked for new submissions. Total processed: %d', len(processed_links))
 
 
 if __name__ == '__main__':
-    logger = setup_logging()
+    setup_logging('pocop_bot')
 
     try:
-        webhook_sanity_check()
+        webhook_sanity_check(WEBHOOK_URL)
     except Exception as e:
         logger.error(e)
         sys.exit(1)
@@ -191,47 +266,15 @@ if __name__ == '__main__':
     processed_links = set()
 
     # Initial fetch and post all existing submissions
-    initial_submissions = get_latest_submissions()
-    logger.info(f'Found {len(initial_submissions)} initial submissions')
+    initial_submissions = get_latest_submissions(processed_links)
+    logger.info('Found %d initial submissions', len(initial_submissions))
 
     # Post all initial submissions
     for submission in initial_submissions:
-        if submission.link:  # Make sure link exists
-            logger.info(f'Posting initial submission: {submission.link}')
-            post_data = submission_to_post_data(submission)
-            discord_comment(post_data)
-            processed_links.add(submission.link)
-            time.sleep(2)  # Rate limiting for Discord API
-
-    logger.info(f'Initialized with {len(processed_links)} submission links')
-
-    while True:
-        try:
-            # Fetch latest submissions
-            current_submissions = get_latest_submissions()
-
-            # Check for new submissions
-            for submission in current_submissions:
-                if submission.link and submission.link not in processed_links:
-                    logger.info(f'New submission found: {submission.link}')
-                    post_data = submission_to_post_data(submission)
-                    discord_comment(post_data)
-                    processed_links.add(submission.link)
-                    time.sleep(2)  # Rate limiting for Discord API
-
-            logger.info(f'Checked for new submissions. Total processed: {len(processed_links)}')
-
-        except http.client.RemoteDisconnected:
-            logger.warning('Remote end closed connection without response')
-        except urllib.error.HTTPError as e:
-            logger.warning(f'HTTP Error occurred with status code: {e.code}')
-        except urllib.error.URLError as e:
-            logger.warning(f'URL Error occurred: {e.reason}')
-        except http.client.HTTPException:
-            logger.warning('HTTP Exception occurred')
-        except socket.timeout:
-            logger.warning('Socket Timeout occurred')
-        except Exception as e:
-            logger.error(f'Unexpected error: {e}')
-        finally:
-            time.sleep(120)  # Check every 2 minutes
\ No newline at end of file
+        logger.info('Posting initial submission: %s', submission.link)
+        post_submission(submission, processed_links)
+
+    logger.info('Initialized with %d submission links', len(processed_links))
+
+    # Check every 2 minutes
+    poll_forever(lambda: check_new_submissions(processed_links), 120)
@@ -0,0 +1,160 @@
+import pytest
+
+import cdp
+import liquidations
+import pocop
+from bot_core import MAX_COMMENT_LENGTH
+
+
+def make_cdp(owner, collateral_ada, minted=1_000_000, asset='iUSD', output_hash='a' * 64):
+    return {
+        'output_hash': output_hash,
+        'output_index': 0,
+        'owner': owner,
+        'asset': asset,
+        'collateralAmount': int(collateral_ada * 1_000_000),
+        'mintedAmount': minted,
+    }
+
+
+def test_batch_comments_fills_up_to_max_length():
+    # Two of these plus the '\n\n' separator are exactly MAX_COMMENT_LENGTH.
+    half = 'a' * ((MAX_COMMENT_LENGTH - 2) // 2)
+    assert cdp.batch_comments([half, half]) == [half + '\n\n' + half]
+    assert cdp.batch_comments([half, half + 'a']) == [half, half + 'a']
+
+
+def test_batch_comments_keeps_order():
+    assert cdp.batch_comments([]) == []
+    assert cdp.batch_comments(['a', 'b', 'c']) == ['a\n\nb\n\nc']
+
+
+def test_batch_liquidation_posts_keeps_embeds_on_their_own():
+    embed = [{'image': {'url': 'x'}}]
+    posts = [
+        ({'content': 'a'}, {'id': 1}),
+        ({'content': 'b'}, {'id': 2}),
+        ({'content': 'c', 'embeds': embed}, {'id': 3}),
+        ({'content': 'd'}, {'id': 4}),
+    ]
+    assert liquidations.batch_liquidation_posts(posts) == [
+        ({'content': 'a\n\nb'}, {'id': 2}),
+        ({'content': 'c', 'embeds': embed}, {'id': 3}),
+        ({'content': 'd'}, {'id': 4}),
+    ]
+
+
+def test_batch_liquidation_posts_splits_at_max_length():
+    half = 'a' * ((MAX_COMMENT_LENGTH - 2) // 2)
+    posts = [({'content': half}, {'id': i}) for i in range(3)]
+    assert liquidations.batch_liquidation_posts(posts) == [
+        ({'content': half + '\n\n' + half}, {'id': 1}),
+        ({'content': half}, {'id': 2}),
+    ]
+
+
+def test_generate_cdp_events_counts_skipped_changes():
+    old = cdp.normalize_cdps([make_cdp('1' * 56, 500), make_cdp('2' * 56, 50_000)])
+    new = cdp.normalize_cdps([make_cdp('3' * 56, 100), make_cdp('4' * 56, 30_000)])
+
+    events, num_changes = cdp.generate_cdp_events(old, new, min_ada=25_000)
+
+    # Two opens and two closes, only the ones over min_ada are built.
+    assert {(e.type, e.ada) for e in events} == {
+        (cdp.CdpEventType.OPEN, 30_000),
+        (cdp.CdpEventType.CLOSE, 50_000),
+    }
+    assert num_changes == 4
+
+
+def test_validate_cdps_json_samples_head_and_tail():
+    cdps = [make_cdp('1' * 56, 100) for _ in range(4 * cdp.VALIDATION_SAMPLE_SIZE)]
+    middle = len(cdps) // 2
+    cdps[middle] = {**cdps[middle], 'asset': 'too long'}
+
+    assert cdp.validate_cdps_json(cdps, full=False) is None
+    assert cdp.validate_cdps_json(cdps, full=True) is not None
+
+    cdps[-1] = {**cdps[-1], 'asset': 'too long'}
+    assert cdp.validate_cdps_json(cdps, full=False) is not None
+
+
+def submission(i, date=None):
+    return {
+        'link': f'https://x.com/{i}',
+        'wallet': 'w',
+        'date': date if date is not None else f'2024-01-01T00:{i:02d}:00Z',
+    }
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    '''Serves pages of submissions from the returned dict, page number -> response.
+
+    Pages that were requested are recorded under 'requested'.
+    '''
+    served = {}
+    requested = []
+
+    def fetch(page=1, limit=10):
+        requested.append(page)
+        return served.get(page, {'commits': []})
+
+    monkeypatch.setattr(pocop, 'fetch_pocop_submissions', fetch)
+    monkeypatch.setattr(pocop, 'latest_posted_date', None)
+    served['requested'] = requested
+    return served
+
+
+def test_get_latest_submissions_oldest_first(pages):
+    pages[1] = {'commits': [submission(i) for i in range(2, 0, -1)]}
+
+    links = [s.link for s in pocop.get_latest_submissions(set())]
+
+    assert links == ['https://x.com/1', 'https://x.com/2']
+
+
+def test_get_latest_submissions_skips_processed_links(pages):
+    pages[1] = {'commits': [submission(i) for i in range(3, 0, -1)]}
+
+    found = pocop.get_latest_submissions({'https://x.com/2'})
+
+    assert [s.link for s in found] == ['https://x.com/1', 'https://x.com/3']
+
+
+def test_get_latest_submissions_stops_at_posted_page(pages, monkeypatch):
+    pages[1] = {'commits': [submission(i) for i in range(29, 19, -1)]}
+    pages[2] = {'commits': [submission(i) for i in range(19, 9, -1)]}
+    monkeypatch.setattr(
+        pocop, 'latest_posted_date', pocop.parse_iso_datetime('2024-01-01T00:25:00Z')
+    )
+
+    pocop.get_latest_submissions(set(), limit=10)
+
+    assert pages['requested'] == [1]
+
+
+def test_get_latest_submissions_returns_nothing_if_a_page_fails(pages):
+    pages[1] = {'commits': [submission(i) for i in range(29, 19, -1)]}
+    pages[2] = {}
+    pages[3] = {'commits': [submission(i) for i in range(9, 4, -1)]}
+
+    assert pocop.get_latest_submissions(set(), limit=10) == []
+
+
+def test_get_latest_submissions_orders_by_parsed_date(pages):
+    pages[1] = {
+        'commits': [
+            submission(1, '2024-01-01T00:00:00.123Z'),
+            submission(2, '2024-01-01T00:00:00Z'),
+            submission(3, ''),
+            submission(4, '2024-01-01T00:00:01'),
+        ]
+    }
+
+    found = pocop.get_latest_submissions(set())
+
+    # Mixed precision sorts by time, not as strings; dates that are missing or
+    # have no UTC offset can't be ordered and are skipped.
+    assert [s.link for s in found] == ['https://x.com/2', 'https://x.com/1']
+    assert all(pocop.parse_submission_date(s.date) is not None for s in found)